@@ -1,34 +1,80 @@
 import os
-import json
+import re
+import logging
+import time
+import hashlib
+import sqlite3
+import threading
 import uuid
+import httpx
+import orjson
 import requests
+import numpy as np
+from cachetools import TTLCache
+from collections import Counter, OrderedDict
+from contextlib import closing
+from functools import wraps
 from pathlib import Path
+from requests.adapters import HTTPAdapter
 from datetime import datetime
-from typing import TypedDict, Annotated, Sequence, List, Dict
+from typing import TypedDict, Annotated, Sequence, List, Dict, Callable, Optional
 from dotenv import load_dotenv
+from pydantic import BaseModel, Field, ValidationError
 from langgraph.graph import StateGraph, add_messages
 from langgraph.prebuilt import InjectedState, ToolNode, tools_condition
 from langchain_openai import ChatOpenAI, OpenAIEmbeddings
 from langchain.tools import tool
 from langgraph.checkpoint.memory import MemorySaver
 from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage, AIMessage
+from langchain_core.exceptions import OutputParserException
 
 load_dotenv()
 DB_PATH = Path("db")
+logger = logging.getLogger(__name__)
 
 ### UTILS
 
+def to_columnar(rows: list, columns: Optional[List[str]] = None) -> dict:
+    """
+    Pivot a list of row dicts into columnar form.
+
+    Parameters
+    ----------
+    rows : list
+        Rows as returned by Apps Script: [ {field1: val, field2: val}, ... ]
+    columns : list[str] | None
+        Known header of the sheet. Its fields are kept even when no row has
+        them (e.g. an empty sheet); extra keys found in the rows are appended.
+
+    Returns
+    -------
+    dict
+        {
+            "columns": ["field1", "field2"],
+            "rows": [ [val, val], ... ],
+            "index": {"field1": 0, "field2": 1}
+        }
+        Fields missing from a row are filled with None.
+    """
+    columns = list(dict.fromkeys([*(columns or []), *(k for row in rows for k in row)]))
+    return {
+        "columns": columns,
+        "rows": [[row.get(c) for c in columns] for row in rows],
+        "index": {c: i for i, c in enumerate(columns)},
+    }
+
+
 def filter_fields(data: dict, fields_to_keep: dict) -> dict:
     """
-    Keep only specific fields for each heading's rows.
+    Keep only specific fields (columns) for each heading's rows.
 
     Parameters
     ----------
     data : dict
-        Input dictionary with structure like:
+        Input dictionary of columnar sheets (see `to_columnar`):
         {
-            "Heading1": {"rows": [ {field1: val, field2: val}, ... ]},
-            "Heading2": {"rows": [ ... ]}
+            "Heading1": {"columns": [...], "rows": [ [val, val], ... ], "index": {...}},
+            "Heading2": { ... }
         }
 
     fields_to_keep : dict
@@ -41,32 +87,284 @@ def filter_fields(data: dict, fields_to_keep: dict) -> dict:
     Returns
     -------
     dict
-        New dictionary with only the requested fields kept.
+        New dictionary with only the requested columns kept:
+        {
+            "Heading1": {"columns": ["Field1"], "rows": [ [val], ... ], "total_rows": N},
+            ...
+        }
     """
     result = {}
 
     for heading, content in data.items():
+        rows = content.get("rows", [])
+        col_index = content.get("index", {})
         # Get the fields we need for this heading (default to empty list if not provided)
-        keep_fields = fields_to_keep.get(heading, [])
+        keep_fields = [f for f in fields_to_keep.get(heading, []) if f in col_index]
+
+        if not keep_fields:
+            result[heading] = {"columns": [], "rows": [], "total_rows": len(rows)}
+            continue
 
-        # Filter each row to only keep those fields
-        filtered_rows = []
-        for row in content.get("rows", []):
-            filtered_row = {k: row[k] for k in keep_fields if k in row}
-            filtered_rows.append(filtered_row)
-        result[heading] = {}
-        result[heading]["rows"] = filtered_rows
-        result[heading]["total_rows"] = len(content.get("rows", []))
+        # Slice the kept columns out of each row
+        idxs = [col_index[f] for f in keep_fields]
+        filtered_rows = [[row[i] for i in idxs] for row in rows]
+        result[heading] = {"columns": keep_fields, "rows": filtered_rows, "total_rows": len(rows)}
 
     return result
 
 
+def summarize_sheets(data: dict, fields_to_keep: dict, sample_size: int = 3) -> dict:
+    """
+    Build a compact overview of the loaded sheets for the LLM, instead of the full rows.
+
+    Parameters
+    ----------
+    data : dict
+        Loaded columnar sheets (see `to_columnar`).
+    fields_to_keep : dict
+        Dictionary mapping each heading to the fields relevant to the query.
+    sample_size : int
+        Number of leading rows to include as a sample.
+
+    Returns
+    -------
+    dict
+        {
+            "Heading1": {
+                "fields": ["Field1", ...],        # every column of the sheet
+                "total_rows": N,
+                "sample": [ {"Field1": val}, ... ] # relevant fields of the first rows
+            },
+            ...
+        }
+    """
+    heads = {heading: {**content, "rows": content.get("rows", [])[:sample_size]} for heading, content in data.items()}
+    samples = filter_fields(heads, fields_to_keep)
+
+    return {
+        heading: {
+            "fields": content.get("columns", []),
+            "total_rows": len(content.get("rows", [])),
+            "sample": [dict(zip(samples[heading]["columns"], row)) for row in samples[heading]["rows"]],
+        }
+        for heading, content in data.items()
+    }
+
+
+def get_column(data, sheet_name: str, field: str) -> Optional[list]:
+    """Returns all values of `field` in a loaded columnar sheet, or None if either does not exist."""
+    sheet = (data or {}).get(sheet_name, {})
+    idx = sheet.get("index", {}).get(field)
+    if idx is None:
+        return None
+    return [row[idx] for row in sheet["rows"]]
+
+
+class EmbeddingCache:
+    """
+    Text -> embedding vector store, persisted to disk.
+
+    Vectors are keyed by the SHA-256 of the text and kept as rows of a sqlite
+    database at `path`, so that nothing is re-embedded across restarts.
+    Uncached texts are embedded together in a single `embed_documents` request.
+    Only the `maxsize` most recently used vectors are kept.
+    """
+
+    def __init__(self, embeddings, path: Path, maxsize: int = 4096):
+        self.embeddings = embeddings
+        self.path = path
+        self.maxsize = maxsize
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS vectors (key TEXT PRIMARY KEY, vector BLOB, used_at REAL)")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _key(self, text: str) -> str:
+        # Vectors of different embedding models are not comparable
+        model = getattr(self.embeddings, "model", "")
+        return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+    def _load(self, conn: sqlite3.Connection, keys: List[str]) -> Dict[str, np.ndarray]:
+        placeholders = ",".join("?" * len(keys))
+        rows = conn.execute(f"SELECT key, vector FROM vectors WHERE key IN ({placeholders})", keys)
+        return {key: np.frombuffer(blob, dtype=np.float32) for key, blob in rows}
+
+    def get(self, text: str) -> Optional[np.ndarray]:
+        with closing(self._connect()) as conn:
+            return self._load(conn, [self._key(text)]).get(self._key(text))
+
+    def embed_many(self, texts: List[str]) -> List[np.ndarray]:
+        """Returns one vector per text, in order, embedding only the uncached ones."""
+        keys = [self._key(text) for text in texts]
+        with closing(self._connect()) as conn:
+            vectors = self._load(conn, list(set(keys)))
+
+        uncached = {key: text for key, text in zip(keys, texts) if key not in vectors}
+        if uncached:
+            embedded = self.embeddings.embed_documents(list(uncached.values()))
+            for key, vector in zip(uncached.keys(), embedded):
+                vectors[key] = np.asarray(vector, dtype=np.float32)
+
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO vectors (key, vector, used_at) VALUES (?, ?, ?)",
+                [(key, vectors[key].tobytes(), now) for key in set(keys)],
+            )
+            if uncached:
+                conn.execute(
+                    "DELETE FROM vectors WHERE key NOT IN (SELECT key FROM vectors ORDER BY used_at DESC LIMIT ?)",
+                    (self.maxsize,),
+                )
+
+        return [vectors[key] for key in keys]
+
+    def embed(self, text: str) -> np.ndarray:
+        return self.embed_many([text])[0]
+
+
+class LRUEmbeddingCache:
+    """
+    Query -> value cache with two layers.
+
+    1. Exact match on the normalized query text.
+    2. Semantic match, reusing the value of the most similar cached query
+       when its embedding cosine similarity is above `threshold`. If given,
+       `compatible(cached_query, query)` must also hold, to rule out queries
+       that embed closely but differ in what matters (e.g. the sheet named).
+
+    Entries expire after `ttl` seconds and the least recently used entry is
+    evicted once `maxsize` is reached.
+    """
+
+    def __init__(self, embed: Callable[[str], List[float]], maxsize: int = 512, ttl: float = 3600, threshold: float = 0.95, compatible: Optional[Callable[[str, str], bool]] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.threshold = threshold
+        self.compatible = compatible
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._embed = embed
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(query: str) -> str:
+        return " ".join(query.strip().lower().split())
+
+    def _vector(self, key: str) -> Optional[np.ndarray]:
+        try:
+            return np.asarray(self._embed(key), dtype=np.float32)
+        except Exception as e:
+            logger.warning("Embedding failed, skipping semantic cache: %s", e)
+            return None
+
+    def _evict_expired(self):
+        now = time.monotonic()
+        for key in [k for k, (_, _, expires_at) in self._entries.items() if expires_at <= now]:
+            del self._entries[key]
+
+    def get(self, query: str):
+        """Returns the cached value for `query`, or None on a miss."""
+        key = self._normalize(query)
+        with self._lock:
+            self._evict_expired()
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key][0]
+            keys = [
+                k for k, (_, vector, _) in self._entries.items()
+                if vector is not None and (self.compatible is None or self.compatible(k, key))
+            ]
+            if not keys:
+                return None
+            M = np.stack([self._entries[k][1] for k in keys])
+
+        q = self._vector(key)
+        if q is None:
+            return None
+
+        sims = np.dot(M, q) / (np.linalg.norm(M, axis=1) * np.linalg.norm(q) + 1e-12)
+        best = int(np.argmax(sims))
+        if sims[best] < self.threshold:
+            return None
+
+        with self._lock:
+            entry = self._entries.get(keys[best])
+            if entry is None:
+                return None
+            self._entries.move_to_end(keys[best])
+            return entry[0]
+
+    def set(self, query: str, value):
+        key = self._normalize(query)
+        vector = self._vector(key)
+        with self._lock:
+            self._entries[key] = (value, vector, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+def same_sheets_mentioned(a: str, b: str) -> bool:
+    """True when both queries name exactly the same sheets of `SHEETS_SCHEMA` (possibly none)."""
+    def mentioned(query: str) -> set:
+        query = query.lower()
+        return {name for name in SHEETS_SCHEMA if name.lower() in query}
+
+    return mentioned(a) == mentioned(b)
+
+
+def cached_selector(func):
+    """Serves `relevant_sheets` from `selector_cache` and only calls the selector on a miss."""
+
+    @wraps(func)
+    def wrapper(state):
+        query = str(state["messages"][-1].content)
+        sheets = selector_cache.get(query)
+        if sheets is not None:
+            return {"relevant_sheets": sheets}
+
+        update = func(state)
+        # Empty selections are not cached: they may be the fallback for an
+        # unparseable selector reply, and are cheap to miss otherwise
+        if update["relevant_sheets"]:
+            selector_cache.set(query, update["relevant_sheets"])
+        return update
+
+    return wrapper
+
+
+GREETINGS = {"hi", "hello", "hey", "thanks", "thank you", "ok", "okay", "bye"}
+GREETING_RE = re.compile(r"^(hi+|hello|hey|good (morning|evening|afternoon)|thanks|thank you|ok|okay|bye)( diya)?[!.? ]*$")
+
+def skip_smalltalk(func):
+    """Selects no sheets for greetings and other trivial messages, without calling the selector."""
+
+    @wraps(func)
+    def wrapper(state):
+        msg = str(state["messages"][-1].content).strip().lower()
+        if len(msg) < 4 or msg in GREETINGS or GREETING_RE.match(msg):
+            return {"relevant_sheets": {}}
+        return func(state)
+
+    return wrapper
+
+
 ### STATE
 class AgentState(TypedDict):
     messages: Annotated[Sequence[BaseMessage], add_messages]
     relevant_sheets: Dict[str, List[str]]
     data: str | dict
 
+class SelectorOut(BaseModel):
+    """Sheets relevant to the user's query"""
+    sheets: Dict[str, List[str]] = Field(
+        default_factory=dict,
+        description="Maps each relevant sheet name to at most 4 relevant fields of that sheet. Empty when no sheet is relevant.",
+    )
+
 ### TOOLS
 
 @tool
@@ -76,11 +374,6 @@ def get_datetime() -> str:
     """
     return datetime.now().strftime("%d-%m-%Y %H:%M:%S")
 
-@tool
-def count_rows(rows: List) -> int:
-    """Given a list of rows, it returns a the count"""
-    return len(rows)
-
 @tool
 def get_summary(sheet_name: str, id_field: str, id_value: str, state: Annotated[AgentState, InjectedState]) -> Dict:
     """
@@ -101,63 +394,202 @@ def get_summary(sheet_name: str, id_field: str, id_value: str, state: Annotated[
     dict | None
         Row data as JSON (Python dict). If not found, returns None.
     """
-    data = state["data"][sheet_name]
-    rows = data.get(sheet_name, {}).get("rows", [])
+    sheet = (state["data"] or {}).get(sheet_name, {})
+    idx = sheet.get("index", {}).get(id_field)
+    if idx is None:
+        return None
 
     # Find the row where id_field matches id_value
-    for row in rows:
-        if str(row.get(id_field, "")).strip() == str(id_value).strip():
-            return row  # already dict/JSON
+    for row in sheet["rows"]:
+        if str(row[idx]).strip() == str(id_value).strip():
+            return dict(zip(sheet["columns"], row))
 
     return None
 
+@tool
+def count_where(sheet_name: str, field: str, value: str, state: Annotated[AgentState, InjectedState]) -> int | None:
+    """
+    Count the rows of a sheet whose field equals the given value
+    (case-insensitive, ignoring surrounding whitespace).
 
+    Parameters
+    ----------
+    sheet_name : str
+        Name of the sheet (e.g., "PO Pending", "Checklist").
+    field : str
+        The field/column name to check (e.g., "Status").
+    value : str
+        The value to match (e.g., "Pending").
 
-tools = [get_datetime, count_rows, get_summary]
-
-#### INITIALIZATION
+    Returns
+    -------
+    int | None
+        Number of matching rows. None if the sheet or field is not loaded.
+    """
+    column = get_column(state["data"], sheet_name, field)
+    if column is None:
+        return None
 
-llm = ChatOpenAI(model="gpt-4.1", api_key=os.getenv("OPENAI_API_KEY")).bind_tools(tools)
-embeddings = OpenAIEmbeddings(api_key=os.getenv("OPENAI_API_KEY"))
+    target = str(value).strip().lower()
+    return sum(1 for v in column if str(v).strip().lower() == target)
 
-#### NODES
+@tool
+def group_by(sheet_name: str, field: str, state: Annotated[AgentState, InjectedState], top: int = 20) -> Dict | None:
+    """
+    Count the rows of a sheet for the most common distinct values of a field.
 
-def selector(state: AgentState) -> AgentState:
-    """Ask LLM which sheets are relevant"""
+    Parameters
+    ----------
+    sheet_name : str
+        Name of the sheet (e.g., "PO Pending", "Checklist").
+    field : str
+        The field/column name to group on (e.g., "Status", "Party Name").
+    top : int
+        Number of most common values to return (at most 100).
 
-    prompt = f"""
-The data is organized into sheets. Each sheet has a specific meaning and fields:
+    Returns
+    -------
+    dict | None
+        {
+            "counts": {value: row count, ...},  # the `top` most common values, most common first
+            "distinct_values": N,               # number of distinct values in the field
+            "other_rows": M                     # rows whose value is not in `counts`
+        }
+        None if the sheet or field is not loaded.
+    """
+    column = get_column(state["data"], sheet_name, field)
+    if column is None:
+        return None
+
+    top = max(0, min(top, 100))
+    counter = Counter(str(v).strip() for v in column)
+    counts = dict(counter.most_common(top))
+    return {
+        "counts": counts,
+        "distinct_values": len(counter),
+        "other_rows": len(column) - sum(counts.values()),
+    }
 
-1. Checklist — recurring tasks
-   Fields: [Timestamp, Task ID, Firm, Given By, Name, Task Description, Task Start Date, Freq, Enable Reminders, Require Attachment, Actual, Delay, Status, Remarks, Uploaded Image]
+@tool
+def list_rows(sheet_name: str, field_filters: Dict[str, str], state: Annotated[AgentState, InjectedState], fields: Optional[List[str]] = None, limit: int = 50) -> Dict | None:
+    """
+    List the rows of a sheet matching all the given field filters
+    (case-insensitive, ignoring surrounding whitespace).
 
-2. Delegation — task delegation
-   Fields: [Timestamp, Task ID, Firm, Given By, Name, Task Description, Task Start Date, Freq, Enable Reminders, Require Attachment, Planned Date, Actual, Delay, Status, Update Date, Reasons, Total Extent]
+    Parameters
+    ----------
+    sheet_name : str
+        Name of the sheet (e.g., "PO Pending", "Checklist").
+    field_filters : dict
+        Mapping of field/column name to the value it must equal
+        (e.g., {"Status": "Pending"}). Pass an empty dict for all rows.
+    fields : list[str] | None
+        Fields/columns to return for each row. Returns all fields when omitted.
+    limit : int
+        Maximum number of rows to return, clamped to 0..200.
+        Use `total_matches` for counts, not the number of returned rows.
 
-3. Purchase Intransit — material not yet received
-   Fields: [Timestamp, LN-Lift Number, Type, Po Number, Bill No., Party Name, Product Name, Qty, Area Lifting, Lead Time To Reach Factory, Truck No., Driver No., Transporter Name, Bill Image, Bilty No., Type Of Rate, Rate, Truck Qty, Material Rate, Bilty Image, Expected Date To Reach]
+    Returns
+    -------
+    dict | None
+        {"columns": [...], "rows": [ [val, ...], ... ], "total_matches": N}.
+        None if the sheet or a field is not loaded.
+    """
+    sheet = (state["data"] or {}).get(sheet_name)
+    if sheet is None:
+        return None
 
-4. Purchase Receipt — material received
-   Fields: [Timestamp, Lift Number, PO Number, Bill Number, Party Name, Product Name, Date Of Receiving, Total Bill Quantity, Actual Quantity, Qty Difference, Physical Condition, Moisture, Physical Image Of Product, Image Of Weight Slip, Bilty Image, Bilty No., Qty Difference Status, Difference Qty, Type]
+    col_index = sheet["index"]
+    columns = fields or sheet["columns"]
+    if any(f not in col_index for f in list(field_filters) + list(columns)):
+        return None
 
-5. Orders Pending — pending sales orders
-   Fields: [Timestamp, DO-Delivery Order No., PARTY PO NO (As Per Po Exact), Party PO Date, Party Names, Product Name, Quantity, Rate Of Material, Type Of Transporting, Upload SO, Is This Order Through Some Agent, Order Received From, Type Of Measurement, Contact Person Name, Contact Person WhatsApp No., Alumina%, Iron%, Type Of PI, Lead Time For Collection Of Final Payment, Quantity Delivered, Order Cancel, Pending Qty, Material Return, Status]
+    conditions = [(col_index[f], str(v).strip().lower()) for f, v in field_filters.items()]
+    matches = [row for row in sheet["rows"] if all(str(row[i]).strip().lower() == v for i, v in conditions)]
 
-6. Sales Invoices — delivery details
-   Fields: [Timestamp, Bill Date, Delivery Order No., Party Name, Product Name, Quantity Delivered., Bill No., Logistic No., Rate Of Material, Type Of Transporting, Transporter Name, Vehicle Number.]
+    limit = max(0, min(limit, 200))
+    idxs = [col_index[c] for c in columns]
+    return {
+        "columns": columns,
+        "rows": [[row[i] for i in idxs] for row in matches[:limit]],
+        "total_matches": len(matches),
+    }
 
-7. Collection Pending — collections to be received
-   Fields: [Party Names, Total Pending Amount, Expected Date Of Payment, Collection Remarks]
 
-8. Production Orders — production orders
-   Fields: [Timestamp, Delivery Order No., Party Name, Product Name, Order Quantity, Expected Delivery Date, Order Cancel, Actual Production Planned, Actual Production Done, Stock Transfered, Quantity Delivered, Quantity In Stock, Planning Pending, Production Pending, Status]
 
-9. Job Card Production — job card details
-   Fields: [Timestamp, Do Number, Party Name, Machine Name, Job Card No., Date Of Production, Name Of Supervisor, Product Name, Quantity Of FG]
+tools = [get_datetime, get_summary, count_where, group_by, list_rows]
 
-10. PO Pending - pending purchase orders
-   Fields: ["Timestamp","Indent Number","Have To Make Po","Party Name","Product Name","Quantity","Rate","Alumina %","Iron %","Lead Time To Lift Total Qty","PO Copy","Total Amount","Advance To Be Paid","To Be Paid Amount","When To Be Paid","Notes","Total Lifted","Pending Qty","Order Cancel Qty","Status"]
+#### INITIALIZATION
 
+# One HTTP/2 keep-alive client shared by every OpenAI call
+_http = httpx.Client(
+    http2=True,
+    timeout=60.0,
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=50),
+)
+
+llm = ChatOpenAI(model="gpt-4.1", api_key=os.getenv("OPENAI_API_KEY"), http_client=_http).bind_tools(tools)
+# Function calling (rather than strict JSON schema) since the sheet names are free-form dict keys
+selector_llm = ChatOpenAI(model="gpt-4.1", api_key=os.getenv("OPENAI_API_KEY"), http_client=_http).with_structured_output(SelectorOut, method="function_calling")
+# Pinned, since the selector cache's similarity threshold is tuned for this model
+embeddings = OpenAIEmbeddings(model="text-embedding-3-small", api_key=os.getenv("OPENAI_API_KEY"), http_client=_http)
+
+# Persistent keep-alive connections to Apps Script
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+# Recently loaded sheets, keyed on the sorted sheet names
+_loader_cache = TTLCache(maxsize=64, ttl=120)
+_loader_cache_lock = threading.Lock()
+
+def clear_loader_cache():
+    """Forget recently loaded sheets, e.g. after the sheets were refreshed."""
+    with _loader_cache_lock:
+        _loader_cache.clear()
+
+embedding_cache = EmbeddingCache(embeddings, DB_PATH / "embed_cache.sqlite")
+selector_cache = LRUEmbeddingCache(embedding_cache.embed, threshold=0.95, compatible=same_sheets_mentioned)
+
+#### SCHEMA
+
+SHEET_DESCRIPTIONS = {
+    "Checklist": "recurring tasks",
+    "Delegation": "task delegation",
+    "Purchase Intransit": "material not yet received",
+    "Purchase Receipt": "material received",
+    "Orders Pending": "pending sales orders",
+    "Sales Invoices": "delivery details",
+    "Collection Pending": "collections to be received",
+    "Production Orders": "production orders",
+    "Job Card Production": "job card details",
+    "PO Pending": "pending purchase orders",
+}
+
+SHEETS_SCHEMA: Dict[str, List[str]] = {
+    "Checklist": ["Timestamp", "Task ID", "Firm", "Given By", "Name", "Task Description", "Task Start Date", "Freq", "Enable Reminders", "Require Attachment", "Actual", "Delay", "Status", "Remarks", "Uploaded Image"],
+    "Delegation": ["Timestamp", "Task ID", "Firm", "Given By", "Name", "Task Description", "Task Start Date", "Freq", "Enable Reminders", "Require Attachment", "Planned Date", "Actual", "Delay", "Status", "Update Date", "Reasons", "Total Extent"],
+    "Purchase Intransit": ["Timestamp", "LN-Lift Number", "Type", "Po Number", "Bill No.", "Party Name", "Product Name", "Qty", "Area Lifting", "Lead Time To Reach Factory", "Truck No.", "Driver No.", "Transporter Name", "Bill Image", "Bilty No.", "Type Of Rate", "Rate", "Truck Qty", "Material Rate", "Bilty Image", "Expected Date To Reach"],
+    "Purchase Receipt": ["Timestamp", "Lift Number", "PO Number", "Bill Number", "Party Name", "Product Name", "Date Of Receiving", "Total Bill Quantity", "Actual Quantity", "Qty Difference", "Physical Condition", "Moisture", "Physical Image Of Product", "Image Of Weight Slip", "Bilty Image", "Bilty No.", "Qty Difference Status", "Difference Qty", "Type"],
+    "Orders Pending": ["Timestamp", "DO-Delivery Order No.", "PARTY PO NO (As Per Po Exact)", "Party PO Date", "Party Names", "Product Name", "Quantity", "Rate Of Material", "Type Of Transporting", "Upload SO", "Is This Order Through Some Agent", "Order Received From", "Type Of Measurement", "Contact Person Name", "Contact Person WhatsApp No.", "Alumina%", "Iron%", "Type Of PI", "Lead Time For Collection Of Final Payment", "Quantity Delivered", "Order Cancel", "Pending Qty", "Material Return", "Status"],
+    "Sales Invoices": ["Timestamp", "Bill Date", "Delivery Order No.", "Party Name", "Product Name", "Quantity Delivered.", "Bill No.", "Logistic No.", "Rate Of Material", "Type Of Transporting", "Transporter Name", "Vehicle Number."],
+    "Collection Pending": ["Party Names", "Total Pending Amount", "Expected Date Of Payment", "Collection Remarks"],
+    "Production Orders": ["Timestamp", "Delivery Order No.", "Party Name", "Product Name", "Order Quantity", "Expected Delivery Date", "Order Cancel", "Actual Production Planned", "Actual Production Done", "Stock Transfered", "Quantity Delivered", "Quantity In Stock", "Planning Pending", "Production Pending", "Status"],
+    "Job Card Production": ["Timestamp", "Do Number", "Party Name", "Machine Name", "Job Card No.", "Date Of Production", "Name Of Supervisor", "Product Name", "Quantity Of FG"],
+    "PO Pending": ["Timestamp", "Indent Number", "Have To Make Po", "Party Name", "Product Name", "Quantity", "Rate", "Alumina %", "Iron %", "Lead Time To Lift Total Qty", "PO Copy", "Total Amount", "Advance To Be Paid", "To Be Paid Amount", "When To Be Paid", "Notes", "Total Lifted", "Pending Qty", "Order Cancel Qty", "Status"],
+}
+
+#### PROMPTS
+
+# Static prompt prefixes are kept byte-identical across turns so that the
+# provider's automatic prompt cache can reuse them. Per-turn content (user
+# query, sheet data) is always sent as a separate message after them.
+
+SELECTOR_PREFIX = "\nThe data is organized into sheets. Each sheet has a specific meaning and fields:\n\n" + "\n\n".join(
+    f"{i}. {name} — {SHEET_DESCRIPTIONS[name]}\n   Fields: [{', '.join(fields)}]"
+    for i, (name, fields) in enumerate(SHEETS_SCHEMA.items(), 1)
+) + "\n"
+
+SELECTOR_SUFFIX = """
 Your job is to
 - Provide relevant sheet for the User Query
 - At most 4 Relevant Fields/columns from the sheet for the User query
@@ -171,13 +603,12 @@ Your job is to
         "Give me total number for pending rows in Checklist"
     Would have "Status" as the field for the "Checklist" Sheet
 
-User: {state["messages"][-1]}
-Give a list of only relevant sheets as a JSON. Don't use markup. Don't use `. Use the following format strictly
-{{
+Give only the relevant sheets as `sheets`, mapping each sheet name to its relevant fields:
+{
     "Sheet Name": ["Field1", Field2, ...],
     ...
-}}
-If no relevant sheets found return empty JSON, when no relevant fields return empty array
+}
+If no relevant sheets found return empty `sheets`, when no relevant fields return empty array
 
 ### Rules for answering
 
@@ -188,64 +619,94 @@ If no relevant sheets found return empty JSON, when no relevant fields return em
    - If multiple sheets could apply, politely ask for clarification.  
 3. For greeting messages no sheets are relevant.
 4. Never give more thatn 4 fields for one sheet.
-    """
-
-    response = llm.invoke(prompt)
-    try:
-        print(response.content.strip())
-        sheets = json.loads(response.content.strip())
-    except:
-        sheets = {}
-
-    return {**state, "relevant_sheets": sheets}
+"""
 
-def loader(state: AgentState) -> AgentState:
-    """Load selected sheets' data"""
-    data = ""
-    if len(state['relevant_sheets']) != 0:
-        response = requests.request("get", (os.getenv("APPS_SCRIPT_URL") + f"?sheetNames={','.join(state['relevant_sheets'].keys())}"))
-        data = response.json()
-        for key in data.keys():
-            data[key]["total_rows"] = len(data[key]["rows"]) - 1
-    return {**state, "data": data}
-
-def model(state: AgentState) -> AgentState:
-    """Calls LLM to create response for user's query"""
-    relevant_data = {}
-    if len(state["relevant_sheets"].items()) != 0:
-        relevant_data = filter_fields(state["data"], state["relevant_sheets"])
+# Assembled once at import, so every turn sends the very same string object
+SELECTOR_SYSTEM_PROMPT = SELECTOR_PREFIX + SELECTOR_SUFFIX
+SELECTOR_SYSTEM = SystemMessage(content=SELECTOR_SYSTEM_PROMPT)
 
-    system_prompt = SystemMessage(
-            content=f"""
+MODEL_SYSTEM_PROMPT = """
 Your name is Diya. You are an AI agent for Botivate LLP, that resolves user queries regarding there process status and real time analytics. 
 Your concisely reply the user with crisp and meaning full response. Your response should reflect Professionalism.
 
 For any queries relating to the today's date and time use the date time use the `get_datetime` tool.
-Whenever asked to give count or related queries, use the `count_rows` tool, with the list of rows relevant to user query.
+Whenever asked to count rows where a field has a specific value (e.g. how many are pending), use the `count_where` tool with the sheet, field and value.
+Whenever asked for counts broken down by a field (e.g. orders per party, tasks per status), use the `group_by` tool with the sheet and field, it returns the most common values only, along with `distinct_values` and the `other_rows` count.
+For counts with several conditions, use the `list_rows` tool with all the field filters and answer with its `total_matches`.
+Never count the rows returned by a tool or shown in the sample yourself, `list_rows` returns at most `limit` rows.
 Whenever you need more details about a row of data, use the `get_summary` tool with its arguements, this will return extra details about about the row in json.
 
-Reply the user according the following data
+Whenever you need the actual rows of a sheet, use the `list_rows` tool with the sheet, field filters and the fields you need. Rows are returned in columnar form: `columns` lists the field names and every entry in `rows` is a list of values in that same column order.
 
-{json.dumps(relevant_data, indent=2)}
+The next message gives an overview of the sheets loaded for the user's query: their `fields`, `total_rows` and a small `sample` of rows. It does not contain all rows, use the tools above to get them.
 
 ### Rules for answering
 1. Always decide which sheet(s) are relevant before answering.  
 2. Only use the fields listed for those sheets. Do not invent fields or values.  
-3. If user asks tell me the Total Rows, without any aggregation, just the count of total rows, Get it from the `total_rows` field of the sheet only, not the `count_tool`.
+3. If user asks tell me the Total Rows, without any aggregation, just the count of total rows, Get it from the `total_rows` field of the sheet only, not from any tool.
 4. If the user asks a vague question like *"How many are pending?"*:  
    - Look for the sheet(s) where a `"Status"` or `"Pending"` column exists.  
    - If only one sheet contains pending status, assume that's what they mean.  
    - If multiple sheets could apply, politely ask for clarification.  
 5. If the required information does not exist in the data, respond with:  
    **"The data does not contain this information."**  
-6. Never fabricate rows or totals. Only count or extract from the provided JSON files.  
+6. Never fabricate rows or totals. Only count or extract from the provided data and tool results.  
 7. Always answer in a clear, concise, professional tone as Diya.
 """
-    )
 
-    response = llm.invoke([system_prompt] + state["messages"])
+MODEL_SYSTEM = SystemMessage(content=MODEL_SYSTEM_PROMPT)
+
+#### NODES
+
+@skip_smalltalk
+@cached_selector
+def selector(state: AgentState) -> dict:
+    """Ask LLM which sheets are relevant"""
+
+    try:
+        result = selector_llm.invoke([SELECTOR_SYSTEM, HumanMessage(content=str(state["messages"][-1].content))])
+    except (OutputParserException, ValidationError) as e:
+        logger.warning("Could not parse selector reply, selecting no sheets: %s", e)
+        return {"relevant_sheets": {}}
+    if result is None:
+        logger.warning("Selector did not return a selection, selecting no sheets")
+        return {"relevant_sheets": {}}
+
+    # Drop sheets the LLM made up, they would only fail in the loader
+    sheets = {k: v for k, v in result.sheets.items() if k in SHEETS_SCHEMA}
+    logger.debug("Relevant sheets: %s", sheets)
+
+    return {"relevant_sheets": sheets}
+
+def loader(state: AgentState) -> dict:
+    """Load selected sheets' data"""
+    data = ""
+    sheet_names = [name for name in state['relevant_sheets'] if name in SHEETS_SCHEMA]
+    if len(sheet_names) != 0:
+        key = tuple(sorted(sheet_names))
+        with _loader_cache_lock:
+            data = _loader_cache.get(key)
+
+        if data is None:
+            response = _session.get(os.getenv("APPS_SCRIPT_URL") + f"?sheetNames={','.join(key)}", timeout=60)
+            data = orjson.loads(response.content)
+            for name in data.keys():
+                data[name] = to_columnar(data[name].get("rows", []), columns=SHEETS_SCHEMA.get(name))
+            with _loader_cache_lock:
+                _loader_cache[key] = data
+    return {"data": data}
+
+def model(state: AgentState) -> dict:
+    """Calls LLM to create response for user's query"""
+    relevant_data = {}
+    if len(state["relevant_sheets"].items()) != 0 and state["data"]:
+        relevant_data = summarize_sheets(state["data"], state["relevant_sheets"])
+
+    data_prompt = SystemMessage(content=orjson.dumps(relevant_data).decode())
+
+    response = llm.invoke([MODEL_SYSTEM, data_prompt] + state["messages"])
 
-    return {**state, "messages": [response]}
+    return {"messages": [response]}
 
 tool_node = ToolNode(tools)
 
@@ -1,11 +1,31 @@
+import time
 import uuid
+import asyncio
+import threading
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+from langchain_core.messages import AIMessageChunk
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware  # Import the CORS middleware
-from agent import agent  # import your LangGraph graph
+from agent import agent, memory, clear_loader_cache  # import your LangGraph graph and its checkpointer
 from script import main  # import the main() function from script.py
 
-app = FastAPI(title="Diya Analytics Bot")
+# Threads for blocking work: graph runs (including the sync nodes LangGraph
+# runs during astream) and sheet refreshes. Matches the 40 threads FastAPI's
+# sync endpoints had, instead of asyncio's default of min(32, cpu_count + 4).
+WORKER_THREADS = 40
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    executor = ThreadPoolExecutor(max_workers=WORKER_THREADS, thread_name_prefix="diya-worker")
+    asyncio.get_running_loop().set_default_executor(executor)
+    yield
+    executor.shutdown(wait=False)
+
+app = FastAPI(title="Diya Analytics Bot", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -13,40 +33,91 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Session-Id"],
 )
 
-thread_id = str(uuid.uuid4())
-config = {"configurable": {"thread_id": thread_id}}
+# Conversations idle for longer than this (seconds) are dropped from memory
+SESSION_TTL = 60 * 60
+
+_last_seen: "OrderedDict[str, float]" = OrderedDict()
+_sessions_lock = threading.Lock()
+
+def touch_session(thread_id: str):
+    """Mark a conversation as active and delete the checkpoints of expired ones."""
+    now = time.monotonic()
+    expired = []
+    with _sessions_lock:
+        _last_seen[thread_id] = now
+        _last_seen.move_to_end(thread_id)
+        while _last_seen:
+            oldest, seen = next(iter(_last_seen.items()))
+            if now - seen < SESSION_TTL:
+                break
+            _last_seen.popitem(last=False)
+            expired.append(oldest)
+
+    for oldest in expired:
+        memory.delete_thread(oldest)
 
 # Request/Response models
 class QueryRequest(BaseModel):
     message: str
+    session_id: str | None = None
 
 class QueryResponse(BaseModel):
     reply: str
+    session_id: str
 
 @app.get("/")
 def root():
     return {"status": "ok"}
 
-@app.post("/chat", response_model=QueryResponse)
-def chat(req: QueryRequest):
-    # Start graph execution with user message
-    events = agent.stream({"messages": [("user", req.message)]}, config, stream_mode="values")
-
+def run_chat(message: str, config: dict):
+    """Run the graph to completion and return the last message's content (blocking)."""
     reply = None
-    for event in events:
+    for event in agent.stream({"messages": [("user", message)]}, config, stream_mode="values"):
         if "messages" in event:
             reply = event["messages"][-1].content
+    return reply
+
+def start_session(req: QueryRequest):
+    """Each conversation gets its own LangGraph thread."""
+    thread_id = req.session_id or str(uuid.uuid4())
+    touch_session(thread_id)
+    return thread_id, {"configurable": {"thread_id": thread_id}}
+
+@app.post("/chat", response_model=QueryResponse)
+async def chat(req: QueryRequest):
+    thread_id, config = start_session(req)
+
+    # The graph blocks on LLM and Apps Script calls, keep it off the event loop
+    # (runs on the WORKER_THREADS default executor set in `lifespan`)
+    loop = asyncio.get_running_loop()
+    reply = await loop.run_in_executor(None, run_chat, req.message, config)
+
+    return QueryResponse(reply=reply, session_id=thread_id)
+
+@app.post("/chat/stream")
+async def chat_stream(req: QueryRequest):
+    """Same as /chat, but streams the reply as plain text while Diya is writing it."""
+    thread_id, config = start_session(req)
+
+    async def tokens():
+        async for chunk, metadata in agent.astream({"messages": [("user", req.message)]}, config, stream_mode="messages"):
+            # Only the answer itself, not the selector's sheet JSON or tool results
+            if metadata.get("langgraph_node") == "model" and isinstance(chunk, AIMessageChunk) and chunk.content:
+                yield chunk.content
 
-    return QueryResponse(reply=reply)
+    return StreamingResponse(tokens(), media_type="text/plain", headers={"X-Session-Id": thread_id})
 
 
 # ✅ New endpoint to run main() from script.py
 @app.post("/run-script")
-def run_script():
+async def run_script():
     try:
-        result = main()  # call the main function
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(None, main)  # call the main function
+        clear_loader_cache()  # serve the refreshed sheets on the next question
         return {"status": "success", "result": result}
     except Exception as e:
         return {"status": "error", "error": str(e)}
@@ -1,8 +1,14 @@
 import os
-import json
+import time
+import orjson
+import sqlite3
+import hashlib
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from pathlib import Path
+from contextlib import closing
 
 # Load env variables
 load_dotenv()
@@ -26,27 +32,73 @@ SHEETS = [
 db_path = Path("db")
 db_path.mkdir(exist_ok=True)
 
-def fetch_sheet(sheet_name: str):
-    """Fetch one sheet's data from Apps Script endpoint."""
+# One pooled session, so concurrent fetches reuse TLS connections
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_maxsize=len(SHEETS)))
+
+META_PATH = db_path / "meta.sqlite"
+
+def json_path(sheet_name: str) -> Path:
+    return db_path / f"{sheet_name.replace(' ', '_')}.json"
+
+def load_meta() -> dict:
+    """Load {sheet: (etag, sha256)} of the last saved version of each sheet from db/meta.sqlite."""
+    with closing(sqlite3.connect(META_PATH)) as conn:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS sheets (sheet TEXT PRIMARY KEY, etag TEXT, sha256 TEXT, updated_at INTEGER)"
+        )
+        return {sheet: (etag, sha256) for sheet, etag, sha256 in conn.execute("SELECT sheet, etag, sha256 FROM sheets")}
+
+def save_meta(sheet_name: str, etag: str | None, sha256: str):
+    with closing(sqlite3.connect(META_PATH)) as conn, conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO sheets (sheet, etag, sha256, updated_at) VALUES (?, ?, ?, ?)",
+            (sheet_name, etag, sha256, int(time.time())),
+        )
+
+def fetch_sheet(sheet_name: str, meta: tuple | None = None):
+    """
+    Fetch one sheet's data from Apps Script endpoint.
+
+    `meta` is the (etag, sha256) of the last saved version. Returns
+    (data, etag, sha256), with data set to None when the sheet is unchanged.
+    """
+    etag, sha256 = meta or (None, None)
     url = f"{APPS_SCRIPT_URL}?sheetName={sheet_name}"
-    response = requests.get(url)
+    headers = {"If-None-Match": etag} if etag else {}
+    response = session.get(url, headers=headers, timeout=30)
+    if response.status_code == 304:
+        return None, etag, sha256
     response.raise_for_status()
-    return response.json()
+
+    digest = hashlib.sha256(response.content).hexdigest()
+    if digest == sha256:
+        return None, response.headers.get("ETag"), digest
+    return orjson.loads(response.content), response.headers.get("ETag"), digest
 
 def save_json(sheet_name: str, data: dict):
     """Save JSON data to db/<sheet_name>.json"""
-    file_path = db_path / f"{sheet_name.replace(' ', '_')}.json"
-    with open(file_path, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
+    file_path = json_path(sheet_name)
+    with open(file_path, "wb") as f:
+        f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
     print(f"✅ Saved {sheet_name} → {file_path}")
 
 def main():
-    for sheet in SHEETS:
-        try:
-            data = fetch_sheet(sheet)
-            save_json(sheet, data)
-        except Exception as e:
-            print(f"❌ Failed to fetch {sheet}: {e}")
+    # Only trust the stored version of sheets whose file is still on disk
+    meta = {sheet: m for sheet, m in load_meta().items() if json_path(sheet).exists()}
+
+    with ThreadPoolExecutor(max_workers=len(SHEETS)) as executor:
+        futures = {sheet: executor.submit(fetch_sheet, sheet, meta.get(sheet)) for sheet in SHEETS}
+        for sheet, future in futures.items():
+            try:
+                data, etag, sha256 = future.result()
+                if data is None:
+                    print(f"⏭️ {sheet} unchanged")
+                    continue
+                save_json(sheet, data)
+                save_meta(sheet, etag, sha256)
+            except Exception as e:
+                print(f"❌ Failed to fetch {sheet}: {e}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file